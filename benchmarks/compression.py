@@ -0,0 +1,61 @@
+import json
+from time import perf_counter
+
+from compress import ENCODERS
+from settings import ITEMS_PER_PAGE
+
+#
+# Bandwidth vs CPU tradeoff of each available encoding and level,
+# on a synthetic "GET /users" page (ITEMS_PER_PAGE users) sent
+# either at once or streamed in one chunk per user.
+#
+# Usage: PYTHONPATH=freeradius-api python benchmarks/compression.py
+#
+
+LEVELS = {"gzip": range(1, 10), "br": range(12), "zstd": range(1, 20)}
+ROUNDS = 20
+
+
+def make_users_page(count: int = ITEMS_PER_PAGE) -> list[bytes]:
+    users = [
+        {
+            "username": f"cust-{i:06}@adsl",
+            "checks": [{"attribute": "Cleartext-Password", "op": ":=", "value": f"pass-{i * 7919 % 100000}"}],
+            "replies": [
+                {"attribute": "Framed-IP-Address", "op": ":=", "value": f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"},
+                {"attribute": "Framed-Route", "op": "+=", "value": "192.168.1.0/24"},
+                {"attribute": "Framed-Route", "op": "+=", "value": "192.168.2.0/24"},
+                {"attribute": "Huawei-Vpn-Instance", "op": ":=", "value": f"vrf-{i % 50}"},
+            ],
+            "groups": [{"groupname": "100m", "priority": 1}],
+        }
+        for i in range(count)
+    ]
+    return [json.dumps(user).encode() for user in users]
+
+
+def bench(encoding: str, level: int, chunks: list[bytes]) -> tuple[int, float]:
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        encoder = ENCODERS[encoding](level)
+        size = sum(len(encoder.compress(chunk)) for chunk in chunks) + len(encoder.finish())
+    return size, (perf_counter() - start) / ROUNDS
+
+
+def main():
+    chunks = make_users_page()
+    raw_size = sum(len(chunk) for chunk in chunks)
+    print(f"raw size: {raw_size} bytes ({len(chunks)} users)")
+    print(f"{'encoding':<8} {'level':>5} {'whole ratio':>12} {'whole ms':>9} {'stream ratio':>13} {'stream ms':>10}")
+    for encoding in ENCODERS:
+        for level in LEVELS[encoding]:
+            whole_size, whole_time = bench(encoding, level, [b"".join(chunks)])
+            stream_size, stream_time = bench(encoding, level, chunks)
+            print(
+                f"{encoding:<8} {level:>5} {raw_size / whole_size:>12.2f} {whole_time * 1000:>9.3f}"
+                f" {raw_size / stream_size:>13.2f} {stream_time * 1000:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -62,3 +62,13 @@ CREATE TABLE IF NOT EXISTS nas (
   PRIMARY KEY (id),
   KEY nasname (nasname)
 ) ENGINE = INNODB;
+
+-- Not part of the FreeRADIUS schema: used by the API workers to keep
+-- their in-process state coherent (see COHERENCE_ENABLED in settings.py)
+CREATE TABLE IF NOT EXISTS radapi_generation (
+  name varchar(64) NOT NULL,
+  generation bigint unsigned NOT NULL default 0,
+  PRIMARY KEY (name)
+) ENGINE = INNODB;
+
+INSERT IGNORE INTO radapi_generation (name, generation) VALUES ('nas', 0), ('users', 0), ('groups', 0);
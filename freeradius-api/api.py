@@ -1,13 +1,29 @@
 from dataclasses import dataclass
+from ipaddress import IPv4Address, IPv6Address
 from typing import Annotated
+from urllib.parse import quote
 
 from fastapi import APIRouter, FastAPI, HTTPException, Query, Response
 from pyfreeradius.models import Group, Nas, User
 from pyfreeradius.params import GroupUpdate, NasUpdate, UserUpdate
 from pyfreeradius.services import ServiceExceptions
 
-from dependencies import GroupServiceDep, NasServiceDep, UserServiceDep
-from settings import API_URL, ITEMS_PER_PAGE
+from coherence import coherence
+from compress import CompressionMiddleware
+from counts import count_cache, group_users_key
+from dependencies import (
+    CountServiceDep,
+    DbSessionDep,
+    GroupServiceDep,
+    NasServiceDep,
+    PostCommitDep,
+    SearchRepositoryDep,
+    UserServiceDep,
+)
+from export import ExportResult, export
+from nas_index import nas_index
+from profiling import ProfilingRoute, profiling_router
+from settings import API_URL, EXPORT_DIR, ITEMS_PER_PAGE, PROFILING_ENABLED
 
 
 # Error model and responses
@@ -19,8 +35,39 @@ class RadAPIError:
 error_404 = {"model": RadAPIError, "description": "Item not found"}
 error_409 = {"model": RadAPIError, "description": "Item already exists"}
 
+
+# Stats models
+@dataclass
+class RadAPIStats:
+    users: int
+    groups: int
+    nas: int
+
+
+@dataclass
+class RadAPIGroupStats:
+    groupname: str
+    users: int
+
+
+# Query parameters shared by the collection routes
+WithTotalQuery = Annotated[
+    bool, Query(description="If set to true, the number of matching items will be set in the X-Total-Count header")
+]
+PrefixQuery = Annotated[str | None, Query(description="If set, only the items whose name starts with it are returned")]
+KeysOnlyQuery = Annotated[bool, Query(description="If set to true, only the names of the items are returned")]
+
+
+def next_page_link(collection: str, key_gt: str, last_key: str, **params) -> str:
+    query = f"{key_gt}={quote(last_key, safe='')}"
+    for name, value in params.items():
+        if value:
+            query += f"&{name}={'true' if value is True else quote(value, safe='')}"
+    return f'<{API_URL}/{collection}?{query}>; rel="next"'
+
+
 # Our API router and routes
-router = APIRouter()
+router = APIRouter(route_class=ProfilingRoute)
 
 
 @router.get("/")
@@ -28,31 +75,120 @@ def read_root():
     return {"Welcome!": f"API docs is available at {API_URL}/docs"}
 
 
-@router.get("/nas", tags=["nas"], status_code=200, response_model=list[Nas])
-def get_nases(nas_service: NasServiceDep, response: Response, nasname_gt: str | None = None):
-    nas = nas_service.find(limit=ITEMS_PER_PAGE, nasname_gt=nasname_gt)
-    if nas:
-        last_nasname = nas[-1].nasname
-        response.headers["Link"] = f'<{API_URL}/nas?nasname_gt={last_nasname}>; rel="next"'
+@router.get("/nas", tags=["nas"], status_code=200, response_model=list[Nas] | list[str])
+def get_nases(
+    nas_service: NasServiceDep,
+    search_repo: SearchRepositoryDep,
+    count_service: CountServiceDep,
+    response: Response,
+    nasname_gt: str | None = None,
+    prefix: PrefixQuery = None,
+    keys_only: KeysOnlyQuery = False,
+    with_total: WithTotalQuery = False,
+):
+    if prefix:
+        nasnames = search_repo.find_nasnames(prefix, limit=ITEMS_PER_PAGE, nasname_gt=nasname_gt)
+    else:
+        nasnames = nas_service.find_nasnames(limit=ITEMS_PER_PAGE, nasname_gt=nasname_gt)
+    if with_total:
+        total = search_repo.count_nasnames(prefix) if prefix else count_service.count_nas()
+        response.headers["X-Total-Count"] = str(total)
+    if nasnames:
+        response.headers["Link"] = next_page_link("nas", "nasname_gt", nasnames[-1], prefix=prefix, keys_only=keys_only)
+    if keys_only:
+        return nasnames
+    return [nas for nasname in nasnames if (nas := nas_service.find_one(nasname))]
+
+
+@router.get("/nas:lookup", tags=["nas"], status_code=200, response_model=Nas, responses={404: error_404})
+def lookup_nas(ip: Annotated[IPv4Address | IPv6Address, Query(description="Client IP address to match")]):
+    coherence.check()
+    nas = nas_index.lookup(ip)
+    if nas is None:
+        raise HTTPException(404, f"No NAS matches IP address {ip}")
     return nas
 
 
-@router.get("/users", tags=["users"], status_code=200, response_model=list[User])
-def get_users(user_service: UserServiceDep, response: Response, username_gt: str | None = None):
-    users = user_service.find(limit=ITEMS_PER_PAGE, username_gt=username_gt)
-    if users:
-        last_username = users[-1].username
-        response.headers["Link"] = f'<{API_URL}/users?username_gt={last_username}>; rel="next"'
-    return users
+@router.get("/users", tags=["users"], status_code=200, response_model=list[User] | list[str])
+def get_users(
+    user_service: UserServiceDep,
+    search_repo: SearchRepositoryDep,
+    count_service: CountServiceDep,
+    response: Response,
+    username_gt: str | None = None,
+    prefix: PrefixQuery = None,
+    keys_only: KeysOnlyQuery = False,
+    with_total: WithTotalQuery = False,
+):
+    if prefix:
+        usernames = search_repo.find_usernames(prefix, limit=ITEMS_PER_PAGE, username_gt=username_gt)
+    else:
+        usernames = user_service.find_usernames(limit=ITEMS_PER_PAGE, username_gt=username_gt)
+    if with_total:
+        total = search_repo.count_usernames(prefix) if prefix else count_service.count_users()
+        response.headers["X-Total-Count"] = str(total)
+    if usernames:
+        response.headers["Link"] = next_page_link(
+            "users", "username_gt", usernames[-1], prefix=prefix, keys_only=keys_only
+        )
+    if keys_only:
+        return usernames
+    return [user for username in usernames if (user := user_service.find_one(username))]
+
+
+@router.get("/groups", tags=["groups"], status_code=200, response_model=list[Group] | list[str])
+def get_groups(
+    group_service: GroupServiceDep,
+    search_repo: SearchRepositoryDep,
+    count_service: CountServiceDep,
+    response: Response,
+    groupname_gt: str | None = None,
+    prefix: PrefixQuery = None,
+    keys_only: KeysOnlyQuery = False,
+    with_total: WithTotalQuery = False,
+):
+    if prefix:
+        groupnames = search_repo.find_groupnames(prefix, limit=ITEMS_PER_PAGE, groupname_gt=groupname_gt)
+    else:
+        groupnames = group_service.find_groupnames(limit=ITEMS_PER_PAGE, groupname_gt=groupname_gt)
+    if with_total:
+        total = search_repo.count_groupnames(prefix) if prefix else count_service.count_groups()
+        response.headers["X-Total-Count"] = str(total)
+    if groupnames:
+        response.headers["Link"] = next_page_link(
+            "groups", "groupname_gt", groupnames[-1], prefix=prefix, keys_only=keys_only
+        )
+    if keys_only:
+        return groupnames
+    return [group for groupname in groupnames if (group := group_service.find_one(groupname))]
 
 
-@router.get("/groups", tags=["groups"], status_code=200, response_model=list[Group])
-def get_groups(group_service: GroupServiceDep, response: Response, groupname_gt: str | None = None):
-    groups = group_service.find(limit=ITEMS_PER_PAGE, groupname_gt=groupname_gt)
-    if groups:
-        last_groupname = groups[-1].groupname
-        response.headers["Link"] = f'<{API_URL}/groups?groupname_gt={last_groupname}>; rel="next"'
-    return groups
+@router.get("/stats", tags=["stats"], status_code=200, response_model=RadAPIStats)
+def get_stats(
+    count_service: CountServiceDep,
+    approximate: Annotated[
+        bool, Query(description="If set to true, counts will be estimated from the DB statistics when supported")
+    ] = False,
+):
+    return RadAPIStats(
+        users=count_service.count_users(approximate=approximate),
+        groups=count_service.count_groups(approximate=approximate),
+        nas=count_service.count_nas(approximate=approximate),
+    )
+
+
+@router.get(
+    "/stats/groups/{groupname}",
+    tags=["stats"],
+    status_code=200,
+    response_model=RadAPIGroupStats,
+    responses={404: error_404},
+)
+def get_group_stats(groupname: str, count_service: CountServiceDep, group_service: GroupServiceDep):
+    # checked first so that nothing is cached for a nonexistent group
+    if not group_service.exists(groupname):
+        raise HTTPException(404, "Given group does not exist")
+    return RadAPIGroupStats(groupname=groupname, users=count_service.count_group_users(groupname))
 
 
 @router.get("/nas/{nasname}", tags=["nas"], status_code=200, response_model=Nas, responses={404: error_404})
@@ -80,12 +216,17 @@ def get_group(groupname: str, group_service: GroupServiceDep):
 
 
 @router.post("/nas", tags=["nas"], status_code=201, response_model=Nas, responses={409: error_409})
-def post_nas(nas: Nas, nas_service: NasServiceDep, response: Response):
+def post_nas(
+    nas: Nas, nas_service: NasServiceDep, db_session: DbSessionDep, post_commit: PostCommitDep, response: Response
+):
     try:
         nas_service.create(nas)
     except ServiceExceptions.NasAlreadyExists as exc:
         raise HTTPException(409, str(exc))
 
+    post_commit.append(lambda: nas_index.add(nas))
+    post_commit.append(lambda: count_cache.incr("nas"))
+    coherence.bump(db_session, "nas", post_commit)
     response.headers["Location"] = f"{API_URL}/nas/{nas.nasname}"
     return nas
 
@@ -94,6 +235,8 @@ def post_nas(nas: Nas, nas_service: NasServiceDep, response: Response):
 def post_user(
     user: User,
     user_service: UserServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     response: Response,
     allow_groups_creation: Annotated[
         bool, Query(description="If set to true, nonexistent groups will be created during user creation")
@@ -106,6 +249,15 @@ def post_user(
     except ServiceExceptions.GroupNotFound as exc:
         raise HTTPException(422, str(exc))
 
+    def update_counts():
+        count_cache.incr("users")
+        for usergroup in user.groups:
+            count_cache.incr(group_users_key(usergroup.groupname))
+        if allow_groups_creation:
+            count_cache.invalidate("groups")
+
+    post_commit.append(update_counts)
+    coherence.bump(db_session, "users", post_commit)
     response.headers["Location"] = f"{API_URL}/users/{user.username}"
     return user
 
@@ -114,6 +266,8 @@ def post_user(
 def post_group(
     group: Group,
     group_service: GroupServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     response: Response,
     allow_users_creation: Annotated[
         bool, Query(description="If set to true, nonexistent users will be created during group creation")
@@ -126,22 +280,36 @@ def post_group(
     except ServiceExceptions.UserNotFound as exc:
         raise HTTPException(422, str(exc))
 
+    def update_counts():
+        count_cache.incr("groups")
+        count_cache.set(group_users_key(group.groupname), len(group.users))
+        if allow_users_creation:
+            count_cache.invalidate("users")
+
+    post_commit.append(update_counts)
+    coherence.bump(db_session, "groups", post_commit)
     response.headers["Location"] = f"{API_URL}/groups/{group.groupname}"
     return group
 
 
 @router.delete("/nas/{nasname}", tags=["nas"], status_code=204, responses={404: error_404})
-def delete_nas(nasname: str, nas_service: NasServiceDep):
+def delete_nas(nasname: str, nas_service: NasServiceDep, db_session: DbSessionDep, post_commit: PostCommitDep):
     try:
         nas_service.delete(nasname)
     except ServiceExceptions.NasNotFound as exc:
         raise HTTPException(404, str(exc))
 
+    post_commit.append(lambda: nas_index.remove(nasname))
+    post_commit.append(lambda: count_cache.incr("nas", -1))
+    coherence.bump(db_session, "nas", post_commit)
+
 
 @router.delete("/users/{username}", tags=["users"], status_code=204, responses={404: error_404})
 def delete_user(
     username: str,
     user_service: UserServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     prevent_groups_deletion: Annotated[
         bool, Query(description="If set to false, user groups without any attributes will be deleted")
     ] = True,
@@ -153,11 +321,22 @@ def delete_user(
     except ServiceExceptions.GroupWouldBeDeleted as exc:
         raise HTTPException(422, str(exc))
 
+    def update_counts():
+        count_cache.incr("users", -1)
+        count_cache.invalidate_prefix(group_users_key(""))
+        if not prevent_groups_deletion:
+            count_cache.invalidate("groups")
+
+    post_commit.append(update_counts)
+    coherence.bump(db_session, "users", post_commit)
+
 
 @router.delete("/groups/{groupname}", tags=["groups"], status_code=204, responses={404: error_404})
 def delete_group(
     groupname: str,
     group_service: GroupServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     ignore_users: Annotated[
         bool, Query(description="If set to true, the group will be deleted even if it still has users")
     ] = False,
@@ -174,14 +353,32 @@ def delete_group(
     except (ServiceExceptions.GroupStillHasUsers, ServiceExceptions.UserWouldBeDeleted) as exc:
         raise HTTPException(422, str(exc))
 
+    def update_counts():
+        count_cache.incr("groups", -1)
+        count_cache.invalidate(group_users_key(groupname))
+        if not prevent_users_deletion:
+            count_cache.invalidate("users")
+
+    post_commit.append(update_counts)
+    coherence.bump(db_session, "groups", post_commit)
+
 
 @router.patch("/nas/{nasname}", tags=["nas"], status_code=200, response_model=Nas, responses={404: error_404})
-def patch_nas(nasname: str, nas_update: NasUpdate, nas_service: NasServiceDep, response: Response):
+def patch_nas(
+    nasname: str,
+    nas_update: NasUpdate,
+    nas_service: NasServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
+    response: Response,
+):
     try:
         updated_nas = nas_service.update(nasname=nasname, nas_update=nas_update)
     except ServiceExceptions.NasNotFound as exc:
         raise HTTPException(404, str(exc))
 
+    post_commit.append(lambda: nas_index.add(updated_nas))
+    coherence.bump(db_session, "nas", post_commit)
     response.headers["Location"] = f"{API_URL}/nas/{nasname}"
     return updated_nas
 
@@ -191,6 +388,8 @@ def patch_user(
     username: str,
     user_update: UserUpdate,
     user_service: UserServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     response: Response,
     allow_groups_creation: Annotated[
         bool, Query(description="If set to true, nonexistent groups will be created during user modification")
@@ -215,6 +414,10 @@ def patch_user(
     ) as exc:
         raise HTTPException(422, str(exc))
 
+    if user_update.groups is not None:
+        post_commit.append(lambda: count_cache.invalidate_prefix(group_users_key("")))
+        post_commit.append(lambda: count_cache.invalidate("groups"))
+    coherence.bump(db_session, "users", post_commit)
     response.headers["Location"] = f"{API_URL}/users/{username}"
     return updated_user
 
@@ -224,6 +427,8 @@ def patch_group(
     groupname: str,
     group_update: GroupUpdate,
     group_service: GroupServiceDep,
+    db_session: DbSessionDep,
+    post_commit: PostCommitDep,
     response: Response,
     allow_users_creation: Annotated[
         bool, Query(description="If set to true, nonexistent users will be created during group modification")
@@ -248,10 +453,35 @@ def patch_group(
     ) as exc:
         raise HTTPException(422, str(exc))
 
+    def update_counts():
+        count_cache.set(group_users_key(groupname), len(updated_group.users))
+        if allow_users_creation or not prevent_users_deletion:
+            count_cache.invalidate("users")
+
+    post_commit.append(update_counts)
+    coherence.bump(db_session, "groups", post_commit)
     response.headers["Location"] = f"{API_URL}/groups/{groupname}"
     return updated_group
 
 
+@router.post("/export", tags=["export"], status_code=200, response_model=ExportResult)
+def post_export(db_session: DbSessionDep):
+    return export(db_session, output_dir=EXPORT_DIR)
+
+
 # API is now ready!
 app = FastAPI(title="FreeRADIUS REST API")
 app.include_router(router)
+if PROFILING_ENABLED:
+    app.include_router(profiling_router)
+app.add_middleware(CompressionMiddleware)
+
+# In-process state to drop when other workers write (see coherence.py)
+coherence.on_change("nas", nas_index.invalidate, lambda: count_cache.invalidate("nas"))
+for scope in ("users", "groups"):
+    # user and group writes may create or delete groups and users and change their memberships
+    coherence.on_change(
+        scope,
+        lambda: count_cache.invalidate("users", "groups"),
+        lambda: count_cache.invalidate_prefix(group_users_key("")),
+    )
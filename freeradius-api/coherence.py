@@ -0,0 +1,94 @@
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import closing
+from threading import Lock
+from time import monotonic
+
+from pyfreeradius.repositories import BaseRepository
+
+from database import db_connect
+from settings import COHERENCE_CHECK_SECONDS, COHERENCE_ENABLED, GENERATION_TABLE
+
+#
+# With several API workers (processes and/or hosts), the in-process state of a
+# worker (NAS index, cached counts) goes stale when another worker handles a write.
+#
+# To keep it coherent without any external service, the database holds a
+# generation number per scope ("nas", "users" and "groups") in GENERATION_TABLE.
+# The write routes bump the generation of their scope in the same transaction as
+# the write itself. Every COHERENCE_CHECK_SECONDS at most, a worker reads the
+# generations (a single tiny query) and, for each scope that changed, calls the
+# callbacks registered for it to drop the related state.
+#
+# A worker bumping a generation takes it into account for itself once the write
+# is committed (its own state is then up to date too) unless another worker
+# bumped it in between.
+#
+
+
+class GenerationRepository(BaseRepository):
+    def find_all(self) -> dict[str, int]:
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(f"SELECT name, generation FROM {GENERATION_TABLE}")
+            return {name: generation for name, generation in db_cursor.fetchall()}
+
+    def bump(self, name: str) -> int:
+        with closing(self.db_session.cursor()) as db_cursor:
+            sql = f"UPDATE {GENERATION_TABLE} SET generation = generation + 1 WHERE name = {self.ph}"
+            db_cursor.execute(sql, (name,))
+            if db_cursor.rowcount == 0:
+                sql = f"INSERT INTO {GENERATION_TABLE} (name, generation) VALUES ({self.ph}, 1)"
+                db_cursor.execute(sql, (name,))
+                return 1
+            db_cursor.execute(f"SELECT generation FROM {GENERATION_TABLE} WHERE name = {self.ph}", (name,))
+            (generation,) = db_cursor.fetchone()
+            return generation
+
+
+class Coherence:
+    def __init__(self, enabled: bool = COHERENCE_ENABLED, check_seconds: float = COHERENCE_CHECK_SECONDS):
+        self.enabled = enabled
+        self.check_seconds = check_seconds
+        self._lock = Lock()
+        self._generations: dict[str, int] | None = None  # as last seen by this worker
+        self._checked_at = 0.0
+        self._callbacks: dict[str, list[Callable[[], None]]] = defaultdict(list)
+
+    def on_change(self, scope: str, *callbacks: Callable[[], None]):
+        self._callbacks[scope].extend(callbacks)
+
+    def check(self, db_session=None):
+        # db_session is optional: a short-lived one is used if not given
+        if not self.enabled or monotonic() - self._checked_at < self.check_seconds:
+            return
+        self._checked_at = monotonic()
+
+        if db_session is None:
+            with closing(db_connect()) as own_db_session:
+                generations = GenerationRepository(own_db_session).find_all()
+        else:
+            generations = GenerationRepository(db_session).find_all()
+
+        with self._lock:
+            previous, self._generations = self._generations, generations
+        if previous is None:
+            return  # first check: there is no state to drop yet
+
+        for scope in previous.keys() | generations.keys():
+            if previous.get(scope, 0) != generations.get(scope, 0):
+                for callback in self._callbacks[scope]:
+                    callback()
+
+    def bump(self, db_session, scope: str, post_commit_hooks: list[Callable[[], None]]):
+        if not self.enabled:
+            return
+        generation = GenerationRepository(db_session).bump(scope)
+        post_commit_hooks.append(lambda: self._seen(scope, generation))
+
+    def _seen(self, scope: str, generation: int):
+        with self._lock:
+            if self._generations is not None and self._generations.get(scope, 0) == generation - 1:
+                self._generations[scope] = generation
+
+
+coherence = Coherence()
@@ -0,0 +1,167 @@
+import zlib
+from typing import Any
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from settings import COMPRESSION_LEVELS, COMPRESSION_MINIMUM_SIZE
+
+# Brotli and Zstandard are optional: they are only offered if their package is installed
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+#
+# The CompressionMiddleware negotiates the response encoding with the client
+# (as per the "Accept-Encoding" request header) and compresses the response
+# body chunk by chunk. Each chunk is flushed so that streamed responses keep
+# being streamed: only the first bytes (up to COMPRESSION_MINIMUM_SIZE) are
+# buffered to decide whether compressing is worth it.
+#
+
+
+class _GzipEncoder:
+    default_level = 6
+
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder:
+    default_level = 4  # rather than 11, which is too slow for on-the-fly compression
+
+    def __init__(self, level: int):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self.compressor.process(data) + self.compressor.finish()
+
+
+class _ZstdEncoder:
+    default_level = 3
+
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+# Supported encodings by order of preference
+ENCODERS: dict[str, Any] = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = _ZstdEncoder
+if brotli is not None:
+    ENCODERS["br"] = _BrotliEncoder
+ENCODERS["gzip"] = _GzipEncoder
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        qvalue = 1.0
+        if params.strip().startswith("q="):
+            try:
+                qvalue = float(params.strip()[2:])
+            except ValueError:
+                qvalue = 0.0
+        accepted[coding.strip().lower()] = qvalue
+
+    wildcard = accepted.get("*", 0.0)
+    candidates = [coding for coding in ENCODERS if accepted.get(coding, wildcard) > 0]
+    return max(candidates, key=lambda coding: accepted.get(coding, wildcard), default=None)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MINIMUM_SIZE,
+        levels: dict[str, int] = COMPRESSION_LEVELS,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = levels
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+        buffer = b""
+        encoder = None
+
+        async def send_compressed(message: Message):
+            nonlocal start_message, buffer, encoder
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if "content-encoding" in headers or message["status"] < 200 or message["status"] in (204, 304):
+                    await send(message)  # already encoded or without body
+                    return
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)  # not compressing this response
+                return
+
+            more_body = message.get("more_body", False)
+
+            if encoder is None:
+                buffer += message.get("body", b"")
+                if len(buffer) < self.minimum_size:
+                    if more_body:
+                        return  # wait for more bytes before deciding
+                    # the whole body is too small to be worth compressing
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": buffer})
+                    return
+
+                encoder_class = ENCODERS[encoding]
+                encoder = encoder_class(self.levels.get(encoding, encoder_class.default_level))
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": encoder.compress(buffer), "more_body": True})
+                else:
+                    body = encoder.finish(buffer)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                buffer = b""
+                return
+
+            body = message.get("body", b"")
+            body = encoder.compress(body) if more_body else encoder.finish(body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
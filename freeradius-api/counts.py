@@ -0,0 +1,167 @@
+from collections.abc import Callable
+from contextlib import closing
+from threading import Lock
+from time import monotonic
+
+from pyfreeradius.repositories import BaseRepository
+
+from settings import COUNT_CACHE_TTL_SECONDS
+
+#
+# Counting users, groups or NASes means a full (index) scan of the tables.
+# To avoid this on every request, exact counts are kept in a CountCache for
+# COUNT_CACHE_TTL_SECONDS and adjusted by the API write routes in between
+# (once their transaction is committed).
+# When the effect of a write on a count cannot be known for sure (e.g.,
+# groups created along with a user), the count is just invalidated.
+#
+# For very large tables, an approximate count can instead be derived from
+# the statistics the database maintains for its query planner (MySQL,
+# MariaDB and PostgreSQL), falling back to an exact count otherwise.
+#
+
+
+class CountRepository(BaseRepository):
+    def _count(self, sql: str, params: tuple = ()) -> int:
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(sql, params) if params else db_cursor.execute(sql)
+            (count,) = db_cursor.fetchone()
+            return int(count or 0)
+
+    def count_users(self) -> int:
+        return self._count(f"""
+            SELECT COUNT(*) FROM (
+                    SELECT username FROM {self.rad_tables.radcheck}
+              UNION SELECT username FROM {self.rad_tables.radreply}
+              UNION SELECT username FROM {self.rad_tables.radusergroup}
+            ) u
+        """)
+
+    def count_groups(self) -> int:
+        return self._count(f"""
+            SELECT COUNT(*) FROM (
+                    SELECT groupname FROM {self.rad_tables.radgroupcheck}
+              UNION SELECT groupname FROM {self.rad_tables.radgroupreply}
+              UNION SELECT groupname FROM {self.rad_tables.radusergroup}
+            ) g
+        """)
+
+    def count_nas(self) -> int:
+        return self._count(f"SELECT COUNT(DISTINCT nasname) FROM {self.rad_tables.nas}")
+
+    def count_group_users(self, groupname: str) -> int:
+        sql = f"SELECT COUNT(DISTINCT username) FROM {self.rad_tables.radusergroup} WHERE groupname = {self.ph}"
+        return self._count(sql, (groupname,))
+
+    def estimate_distinct(self, tables: list[str], column: str) -> int | None:
+        # Estimated number of distinct values of a column, as the max over the given tables
+        # (a lower bound of the number of distinct values of their union), or None if unknown
+        module = self.db_session.__class__.__module__
+        with closing(self.db_session.cursor()) as db_cursor:
+            if "mysql" in module:
+                placeholders = ", ".join([self.ph] * len(tables))
+                sql = f"""SELECT MAX(CARDINALITY) FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})
+                    AND COLUMN_NAME = {self.ph} AND SEQ_IN_INDEX = 1"""
+                db_cursor.execute(sql, (*tables, column))
+                (estimate,) = db_cursor.fetchone()
+                return int(estimate) if estimate is not None else None
+
+            if "psycopg" in module:
+                placeholders = ", ".join([self.ph] * len(tables))
+                sql = f"""SELECT s.n_distinct, c.reltuples FROM pg_stats s
+                    JOIN pg_class c ON c.relname = s.tablename AND c.relkind = 'r'
+                    WHERE s.tablename IN ({placeholders}) AND s.attname = {self.ph}"""
+                db_cursor.execute(sql, (*tables, column))
+                # a negative n_distinct is the opposite of the ratio of distinct values to rows
+                estimates = [int(-n * rows if n < 0 else n) for n, rows in db_cursor.fetchall()]
+                return max(estimates) if estimates else None
+
+        return None
+
+
+class CountCache:
+    def __init__(self, ttl_seconds: float = COUNT_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._counts: dict[str, tuple[int, float]] = {}  # key -> (count, expiry)
+        self._purged_at = monotonic()
+
+    def get(self, key: str, count_func: Callable[[], int]) -> int:
+        with self._lock:
+            cached = self._counts.get(key)
+        if cached and cached[1] > monotonic():
+            return cached[0]
+
+        count = count_func()
+        self.set(key, count)
+        return count
+
+    def set(self, key: str, count: int):
+        now = monotonic()
+        with self._lock:
+            # expired counts are purged (at most once per TTL) not to pile up
+            if now - self._purged_at >= self.ttl_seconds:
+                self._counts = {k: cached for k, cached in self._counts.items() if cached[1] > now}
+                self._purged_at = now
+            self._counts[key] = (count, now + self.ttl_seconds)
+
+    def incr(self, key: str, delta: int = 1):
+        # only adjusts a count already cached (there is nothing to adjust otherwise)
+        with self._lock:
+            if key in self._counts:
+                count, expiry = self._counts[key]
+                self._counts[key] = (max(count + delta, 0), expiry)
+
+    def invalidate(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._counts.pop(key, None)
+
+    def invalidate_prefix(self, prefix: str):
+        with self._lock:
+            for key in [key for key in self._counts if key.startswith(prefix)]:
+                del self._counts[key]
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+count_cache = CountCache()
+
+
+def group_users_key(groupname: str) -> str:
+    return f"group_users:{groupname}"
+
+
+class CountService:
+    def __init__(self, count_repo: CountRepository, cache: CountCache = count_cache):
+        self.count_repo = count_repo
+        self.cache = cache
+
+    def _approximate(self, tables: list[str], column: str, exact_func: Callable[[], int]) -> int:
+        estimate = self.count_repo.estimate_distinct(tables, column)
+        return estimate if estimate is not None else exact_func()
+
+    def count_users(self, approximate: bool = False) -> int:
+        if approximate:
+            rad_tables = self.count_repo.rad_tables
+            tables = [rad_tables.radcheck, rad_tables.radreply, rad_tables.radusergroup]
+            return self._approximate(tables, "username", self.count_users)
+        return self.cache.get("users", self.count_repo.count_users)
+
+    def count_groups(self, approximate: bool = False) -> int:
+        if approximate:
+            rad_tables = self.count_repo.rad_tables
+            tables = [rad_tables.radgroupcheck, rad_tables.radgroupreply, rad_tables.radusergroup]
+            return self._approximate(tables, "groupname", self.count_groups)
+        return self.cache.get("groups", self.count_repo.count_groups)
+
+    def count_nas(self, approximate: bool = False) -> int:
+        if approximate:
+            return self._approximate([self.count_repo.rad_tables.nas], "nasname", self.count_nas)
+        return self.cache.get("nas", self.count_repo.count_nas)
+
+    def count_group_users(self, groupname: str) -> int:
+        return self.cache.get(group_users_key(groupname), lambda: self.count_repo.count_group_users(groupname))
@@ -1,10 +1,14 @@
-from typing import Annotated
+from collections.abc import Callable, Iterator
+from typing import Annotated, Any
 
 from fastapi import Depends
 from pyfreeradius.repositories import GroupRepository, NasRepository, UserRepository
 from pyfreeradius.services import GroupService, NasService, UserService
 
+from coherence import coherence
+from counts import CountRepository, CountService
 from database import db_connect
+from search import SearchRepository
 from settings import RAD_TABLES
 
 #
@@ -14,11 +18,26 @@ from settings import RAD_TABLES
 #   - a short-lived DB session will be established,
 #   - appropriate repositories and services will be instantiated.
 #
+# Routes keeping some in-process state up to date (e.g., the NAS index) do so
+# through post-commit hooks, so that the state never reflects a write which
+# is eventually rolled back. The hooks list is set up before the DB session
+# hence torn down after it: hooks run once the DB session is committed and
+# are skipped on any error (including a failed commit).
+#
+
 
+def get_post_commit_hooks() -> Iterator[list[Callable[[], None]]]:
+    hooks: list[Callable[[], None]] = []
+    yield hooks
+    for hook in hooks:
+        hook()
 
-def get_db_session():
+
+def get_db_session(post_commit_hooks=Depends(get_post_commit_hooks)):
     db_session = db_connect()
     try:
+        # drop the in-process state other workers made stale (if due)
+        coherence.check(db_session)
         yield db_session
     except:
         # on any error, we rollback the DB
@@ -53,9 +72,21 @@ def get_nas_service(db_session=Depends(get_db_session)) -> NasService:
     return NasService(nas_repo=NasRepository(db_session, RAD_TABLES))
 
 
+def get_count_service(db_session=Depends(get_db_session)) -> CountService:
+    return CountService(count_repo=CountRepository(db_session, RAD_TABLES))
+
+
+def get_search_repository(db_session=Depends(get_db_session)) -> SearchRepository:
+    return SearchRepository(db_session, RAD_TABLES)
+
+
 # API routes will depend on the services
 # (using Annotated dependencies for code reuse as per FastAPI doc)
 
 UserServiceDep = Annotated[UserService, Depends(get_user_service)]
 GroupServiceDep = Annotated[GroupService, Depends(get_group_service)]
 NasServiceDep = Annotated[NasService, Depends(get_nas_service)]
+CountServiceDep = Annotated[CountService, Depends(get_count_service)]
+SearchRepositoryDep = Annotated[SearchRepository, Depends(get_search_repository)]
+DbSessionDep = Annotated[Any, Depends(get_db_session)]
+PostCommitDep = Annotated[list[Callable[[], None]], Depends(get_post_commit_hooks)]
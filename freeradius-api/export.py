@@ -0,0 +1,249 @@
+import os
+import re
+import stat
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+from zlib import crc32
+
+from pyfreeradius.models import AttributeOpValue, Nas
+from pyfreeradius.repositories import BaseRepository
+
+from database import db_connect
+from settings import EXPORT_DIR, EXPORT_FILE_MODE, EXPORT_SHARDS, RAD_TABLES
+
+#
+# Compiles the FreeRADIUS database into the formats of the "users" file
+# (rlm_files module) and of the "clients.conf" file, so that edge radiusd
+# instances can authenticate from files rather than from the SQL backend.
+#
+# Each user gets an entry with its own items, followed by an entry per group
+# with the group items (by ascending priority, the order in which rlm_sql
+# processes them). The rlm_files semantics then match the rlm_sql ones:
+#   - the user entry gets "Fall-Through = Yes" (unless its reply items set it)
+#     so that the groups are processed, as with rlm_sql "read_groups" default,
+#   - a group whose check items do not match only has its reply items skipped,
+#   - a matching group ends the processing unless its reply items include
+#     "Fall-Through = Yes" (a group without any item hence ends it too).
+#
+# Values are single-quoted (i.e., taken literally: no "%{...}" expansion) and
+# entries which cannot be safely written (e.g., a control character in a value,
+# an unknown operator or a user named "DEFAULT" which would match any user) are
+# skipped and reported in the ExportResult.
+#
+# Entries are spread over EXPORT_SHARDS files (by hash of the username or the
+# nasname) which are included by the main "users" and "clients.conf" files.
+# A shard is only rewritten if its content changed, and always atomically.
+#
+
+
+class ExportRepository(BaseRepository):
+    # Unlike other repositories, it loads whole tables at once (no query per entity)
+
+    def _find_attributes(self, table: str, key: str) -> dict[str, list[AttributeOpValue]]:
+        attributes = defaultdict(list)
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(f"SELECT {key}, attribute, op, value FROM {table} ORDER BY {key}, id")
+            for name, a, o, v in db_cursor.fetchall():
+                attributes[name].append(AttributeOpValue(attribute=a, op=o, value=v))
+        return attributes
+
+    def find_user_checks(self) -> dict[str, list[AttributeOpValue]]:
+        return self._find_attributes(self.rad_tables.radcheck, "username")
+
+    def find_user_replies(self) -> dict[str, list[AttributeOpValue]]:
+        return self._find_attributes(self.rad_tables.radreply, "username")
+
+    def find_group_checks(self) -> dict[str, list[AttributeOpValue]]:
+        return self._find_attributes(self.rad_tables.radgroupcheck, "groupname")
+
+    def find_group_replies(self) -> dict[str, list[AttributeOpValue]]:
+        return self._find_attributes(self.rad_tables.radgroupreply, "groupname")
+
+    def find_user_groups(self) -> dict[str, list[str]]:
+        user_groups = defaultdict(list)
+        with closing(self.db_session.cursor()) as db_cursor:
+            sql = f"SELECT username, groupname FROM {self.rad_tables.radusergroup} ORDER BY username, priority, id"
+            db_cursor.execute(sql)
+            for username, groupname in db_cursor.fetchall():
+                user_groups[username].append(groupname)
+        return user_groups
+
+    def find_nases(self) -> list[Nas]:
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(f"SELECT nasname, shortname, secret FROM {self.rad_tables.nas} ORDER BY nasname")
+            return [Nas(nasname=n, shortname=sh, secret=se) for n, sh, se in db_cursor.fetchall()]
+
+
+@dataclass
+class ExportResult:
+    users: int = 0
+    nas: int = 0
+    written: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    skipped: list[str] = field(default_factory=list)
+
+
+# Operators of the "users" file (see "man 5 users")
+OPERATORS = {"=", ":=", "+=", "-=", "==", "!=", ">", ">=", "<", "<=", "=~", "!~", "=*", "!*"}
+
+_attribute = re.compile(r"[\w-]+")
+_bare_word = re.compile(r"[\w@.:/+-]+")
+_control_char = re.compile(r"[\x00-\x1f\x7f]")
+
+
+def _quote(value: str) -> str:
+    if _control_char.search(value):
+        raise ValueError(f"control character in {value!r}")
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _name(name: str) -> str:
+    return name if _bare_word.fullmatch(name) else _quote(name)
+
+
+def _pair(item: AttributeOpValue) -> str:
+    if not _attribute.fullmatch(item.attribute):
+        raise ValueError(f"invalid attribute {item.attribute!r}")
+    if item.op not in OPERATORS:
+        raise ValueError(f"invalid operator {item.op!r} for attribute {item.attribute}")
+    return f"{item.attribute} {item.op} {_quote(item.value)}"
+
+
+def _format_entry(
+    name: str, checks: list[AttributeOpValue], replies: list[AttributeOpValue], fall_through: bool
+) -> str:
+    # check items go on the first line, reply items on the next (indented) lines
+    entry = name
+    if checks:
+        entry += "\t" + ", ".join(_pair(c) for c in checks)
+    entry += "\n"
+    pairs = [_pair(r) for r in replies]
+    if fall_through and not any(r.attribute.lower() == "fall-through" for r in replies):
+        pairs.append("Fall-Through = Yes")
+    if pairs:
+        entry += ",\n".join(f"\t{pair}" for pair in pairs) + "\n"
+    return entry + "\n"
+
+
+def format_user(
+    username: str,
+    checks: list[AttributeOpValue],
+    replies: list[AttributeOpValue],
+    groups: list[tuple[list[AttributeOpValue], list[AttributeOpValue]]] | None = None,
+) -> str:
+    # groups are the (checks, replies) of the user groups, by ascending priority
+    if username == "DEFAULT":
+        raise ValueError("username DEFAULT would match any user")
+    name = _name(username)
+    entries = [_format_entry(name, c, r, fall_through=False) for c, r in groups or []]
+    if checks or replies or not entries:
+        entries.insert(0, _format_entry(name, checks, replies, fall_through=bool(entries)))
+    return "".join(entries)
+
+
+def format_client(nas: Nas) -> str:
+    if not _bare_word.fullmatch(nas.nasname):
+        raise ValueError(f"invalid nasname {nas.nasname!r}")
+    lines = [f"client {nas.nasname} {{", f"\tipaddr = {_quote(nas.nasname)}", f"\tsecret = {_quote(nas.secret)}"]
+    if nas.shortname:
+        lines.append(f"\tshortname = {_quote(nas.shortname)}")
+    return "\n".join(lines) + "\n}\n\n"
+
+
+def _shard(name: str, shards: int) -> int:
+    return crc32(name.encode()) % shards
+
+
+def _write_if_changed(path: Path, content: str, result: ExportResult):
+    if path.exists() and path.read_text() == content:
+        result.unchanged.append(str(path))
+        return
+
+    # write to a temporary file in the same directory then rename it (atomic on POSIX)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        # an existing file keeps its mode (e.g., as set by the administrator)
+        os.chmod(tmp_path, stat.S_IMODE(path.stat().st_mode) if path.exists() else EXPORT_FILE_MODE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    result.written.append(str(path))
+
+
+def _write_sharded(output_dir: Path, filename: str, sections: dict[str, str], shards: int, result: ExportResult):
+    # e.g., "clients.conf" includes "clients.d/clients-00" to "clients.d/clients-15"
+    stem = filename.split(".")[0]
+    shard_dir = output_dir / f"{stem}.d"
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    shard_contents = [""] * shards
+    for name in sorted(sections):
+        shard_contents[_shard(name, shards)] += sections[name]
+
+    main_content = "# Generated by freeradius-api: do not edit\n"
+    for i, content in enumerate(shard_contents):
+        _write_if_changed(shard_dir / f"{stem}-{i:02}", content, result)
+        main_content += f"$INCLUDE {stem}.d/{stem}-{i:02}\n"
+
+    # the main file is written last so that it never includes a missing shard
+    _write_if_changed(output_dir / filename, main_content, result)
+
+
+_export_lock = Lock()
+
+
+def export(db_session, output_dir: str | Path = EXPORT_DIR, shards: int = EXPORT_SHARDS) -> ExportResult:
+    export_repo = ExportRepository(db_session, RAD_TABLES)
+    user_checks = export_repo.find_user_checks()
+    user_replies = export_repo.find_user_replies()
+    user_groups = export_repo.find_user_groups()
+    group_checks = export_repo.find_group_checks()
+    group_replies = export_repo.find_group_replies()
+    nases = export_repo.find_nases()
+
+    result = ExportResult()
+    users = {}
+    for username in sorted(user_checks.keys() | user_replies.keys() | user_groups.keys()):
+        groups = [(group_checks.get(g, []), group_replies.get(g, [])) for g in user_groups.get(username, [])]
+        try:
+            users[username] = format_user(
+                username, user_checks.get(username, []), user_replies.get(username, []), groups
+            )
+        except ValueError as exc:
+            result.skipped.append(f"user {username!r}: {exc}")
+    clients = {}
+    for nas in nases:
+        try:
+            clients[nas.nasname] = format_client(nas)
+        except ValueError as exc:
+            result.skipped.append(f"NAS {nas.nasname!r}: {exc}")
+
+    result.users, result.nas = len(users), len(clients)
+    with _export_lock:
+        _write_sharded(Path(output_dir), "users", users, shards, result)
+        _write_sharded(Path(output_dir), "clients.conf", clients, shards, result)
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export the FreeRADIUS database to users and clients.conf files")
+    parser.add_argument("-o", "--output-dir", default=EXPORT_DIR, help=f"output directory (default: {EXPORT_DIR})")
+    parser.add_argument("-s", "--shards", type=int, default=EXPORT_SHARDS, help="number of files per export")
+    args = parser.parse_args()
+
+    with closing(db_connect()) as db_session:
+        result = export(db_session, output_dir=args.output_dir, shards=args.shards)
+    print(f"Exported {result.users} users and {result.nas} NASes: {len(result.written)} files written")
+    for skipped in result.skipped:
+        print(f"Skipped {skipped}", file=sys.stderr)
@@ -0,0 +1,149 @@
+from contextlib import closing
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from threading import Lock, RLock
+from time import monotonic
+
+from pyfreeradius.models import Nas
+
+from database import db_connect
+from settings import NAS_INDEX_REFRESH_SECONDS, RAD_TABLES
+
+#
+# FreeRADIUS matches the source address of a RADIUS client against the
+# "nasname" column of the NAS table, which may hold either an address or
+# a CIDR prefix. The NasIndex below keeps all NASes in a binary prefix
+# tree (one per IP version) so that "which NAS covers this IP?" can be
+# answered with a longest-prefix match without querying the database.
+#
+# The index is updated incrementally by the NAS write routes (once their
+# transaction is committed) and fully reloaded from the database every
+# NAS_INDEX_REFRESH_SECONDS otherwise (e.g., to catch changes made by other
+# processes or outside the API).
+#
+# A single thread reloads at a time: the others keep on using the current
+# trees meanwhile (only the very first load is waited for). Incremental updates made during a reload are journaled
+# and replayed on the new trees, so that they cannot be lost if the reload
+# query did not see them.
+#
+
+
+class _PrefixTree:
+    # Each node is a list [child_0, child_1, nas] (lists are cheaper than objects here)
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.root: list = [None, None, None]
+
+    def insert(self, address: int, prefixlen: int, nas: Nas | None):
+        node = self.root
+        for i in range(prefixlen):
+            bit = (address >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = nas
+
+    def longest_match(self, address: int) -> Nas | None:
+        node = self.root
+        match = node[2]
+        for i in range(self.bits):
+            node = node[(address >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+
+class NasIndex:
+    def __init__(self, refresh_seconds: float = NAS_INDEX_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._lock = Lock()  # guards the trees and the journal
+        self._reload_lock = RLock()  # serializes the reloads
+        self._trees = {4: _PrefixTree(32), 6: _PrefixTree(128)}
+        self._journal: list[tuple[str, Nas | None]] | None = None  # updates made during a reload
+        self._invalidations = 0
+        self._loaded_at: float | None = None
+        self._loaded = False  # whether the trees have been loaded at least once
+
+    @staticmethod
+    def _insert(trees: dict[int, _PrefixTree], nasname: str, nas: Nas | None):
+        try:
+            network = ip_network(nasname, strict=False)
+        except ValueError:
+            return  # nasname is a hostname, it cannot be indexed
+        trees[network.version].insert(int(network.network_address), network.prefixlen, nas)
+
+    def load(self, nases: list[Nas], invalidations: int | None = None):
+        trees = {4: _PrefixTree(32), 6: _PrefixTree(128)}
+        for nas in nases:
+            self._insert(trees, nas.nasname, nas)
+        with self._lock:
+            for nasname, nas_or_none in self._journal or []:
+                self._insert(trees, nasname, nas_or_none)
+            self._trees = trees
+            self._journal = None
+            self._loaded = True
+            # an invalidation received meanwhile may not be reflected by nases
+            if invalidations is None or invalidations == self._invalidations:
+                self._loaded_at = monotonic()
+
+    @staticmethod
+    def _find_nases() -> list[Nas]:
+        with closing(db_connect()) as db_session, closing(db_session.cursor()) as db_cursor:
+            db_cursor.execute(f"SELECT nasname, shortname, secret FROM {RAD_TABLES.nas}")
+            return [Nas(nasname=n, shortname=sh, secret=se) for n, sh, se in db_cursor.fetchall()]
+
+    def reload(self):
+        with self._reload_lock:
+            with self._lock:
+                self._journal = []
+                invalidations = self._invalidations
+            try:
+                nases = self._find_nases()
+            except BaseException:
+                with self._lock:
+                    self._journal = None
+                raise
+            self.load(nases, invalidations)
+
+    def invalidate(self):
+        # the index will be reloaded on next lookup
+        with self._lock:
+            self._invalidations += 1
+            self._loaded_at = None
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or monotonic() - self._loaded_at >= self.refresh_seconds
+
+    def _update(self, nasname: str, nas: Nas | None):
+        with self._lock:
+            self._insert(self._trees, nasname, nas)
+            if self._journal is not None:
+                self._journal.append((nasname, nas))
+
+    def add(self, nas: Nas):
+        # also used on NAS update since it replaces any previous entry
+        self._update(nas.nasname, nas)
+
+    def remove(self, nasname: str):
+        self._update(nasname, None)
+
+    def lookup(self, ip: IPv4Address | IPv6Address | str) -> Nas | None:
+        # if another thread is reloading the index, we answer from the current trees
+        if self.is_stale() and self._reload_lock.acquire(blocking=not self._loaded):
+            try:
+                # another thread may have reloaded the index while we were waiting
+                if self.is_stale():
+                    self.reload()
+            finally:
+                self._reload_lock.release()
+
+        address = ip_address(ip)
+        if isinstance(address, IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        with self._lock:
+            return self._trees[address.version].longest_match(int(address))
+
+
+nas_index = NasIndex()
@@ -0,0 +1,275 @@
+import cProfile
+import io
+import pstats
+import sys
+from collections import deque
+from collections.abc import Callable
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from hmac import compare_digest
+from inspect import iscoroutinefunction
+from itertools import count
+from random import random
+from threading import Lock
+from time import perf_counter
+from typing import Annotated, Any
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+
+from settings import (
+    PROFILING_ENABLED,
+    PROFILING_HEADER,
+    PROFILING_MAX_RECENT,
+    PROFILING_SAMPLE_RATE,
+    PROFILING_TOKEN,
+)
+
+#
+# Opt-in profiling of the API routes, to diagnose latency in production.
+#
+# A request is profiled if either:
+#   - it is sampled (PROFILING_SAMPLE_RATE is the fraction of sampled requests),
+#   - it carries the PROFILING_HEADER set to PROFILING_TOKEN.
+#
+# The profiler is enabled around the whole route handler (dependencies, endpoint
+# and response serialization). Since Python 3.12, cProfile sees all the threads
+# of the process, including the worker threads FastAPI runs our sync routes and
+# dependencies in. Before, it only sees the thread it is enabled in: the endpoint
+# is then profiled on its own in the worker thread (by the ProfilingRoute, with
+# the context of the request) and merged into the profile, but sync dependencies
+# (e.g., establishing the DB session) are not profiled.
+#
+# A single request is profiled at a time per process: a request which should be
+# profiled while another one is gets an "X-Profile-Skipped" response header.
+# Note that a profile may still include calls made meanwhile by other requests
+# (on the event loop and, as of Python 3.12, in the worker threads).
+#
+# Profiles are aggregated per route template and the most recent ones are kept
+# individually; both are exposed through the "/profiles" admin routes.
+#
+# When PROFILING_ENABLED is false, routes are not wrapped at all (no overhead).
+#
+
+_PER_THREAD = sys.version_info < (3, 12)
+_profiling_lock = Lock()
+_profilers: ContextVar[list[cProfile.Profile] | None] = ContextVar("profilers", default=None)
+
+
+@dataclass
+class RequestProfile:
+    id: int
+    method: str
+    path: str
+    route: str
+    duration_ms: float
+    stats: pstats.Stats
+
+
+class ProfileStore:
+    def __init__(self, max_recent: int = PROFILING_MAX_RECENT):
+        self._lock = Lock()
+        self._ids = count(1)
+        self._routes: dict[str, tuple[int, pstats.Stats]] = {}  # route -> (requests, aggregated stats)
+        self._recent: deque[RequestProfile] = deque(maxlen=max_recent)
+
+    @staticmethod
+    def _stats(profilers: list[cProfile.Profile]) -> pstats.Stats | None:
+        stats = None
+        for profiler in profilers:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError:
+                continue  # nothing was profiled by this one
+        return stats
+
+    def add(
+        self, method: str, path: str, route: str, duration_ms: float, profilers: list[cProfile.Profile]
+    ) -> int | None:
+        stats = self._stats(profilers)
+        if stats is None:
+            return None  # nothing was profiled
+        with self._lock:
+            profile_id = next(self._ids)
+            self._recent.append(RequestProfile(profile_id, method, path, route, duration_ms, stats))
+            if route in self._routes:
+                requests, aggregated = self._routes[route]
+                aggregated.add(stats)
+                self._routes[route] = (requests + 1, aggregated)
+            else:
+                # a copy, not to alter the stats of this request
+                self._routes[route] = (1, self._copy(stats))
+        return profile_id
+
+    @staticmethod
+    def _copy(stats: pstats.Stats) -> pstats.Stats:
+        copy = pstats.Stats()
+        copy.add(stats)
+        return copy
+
+    def routes(self) -> dict[str, int]:
+        with self._lock:
+            return {route: requests for route, (requests, _) in self._routes.items()}
+
+    def recent(self) -> list[RequestProfile]:
+        with self._lock:
+            return list(self._recent)
+
+    # the stats returned are copies: the stored ones keep on being aggregated and
+    # printing stats alters them (e.g., sort order and output stream)
+
+    def route_stats(self, route: str) -> pstats.Stats | None:
+        with self._lock:
+            return self._copy(self._routes[route][1]) if route in self._routes else None
+
+    def request_stats(self, profile_id: int) -> pstats.Stats | None:
+        with self._lock:
+            stats = next((profile.stats for profile in self._recent if profile.id == profile_id), None)
+            return self._copy(stats) if stats is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+            self._recent.clear()
+
+
+profile_store = ProfileStore()
+
+
+def _has_valid_token(token: str | None) -> bool:
+    return PROFILING_TOKEN is not None and token is not None and compare_digest(token, PROFILING_TOKEN)
+
+
+def _profiled(endpoint: Callable) -> Callable:
+    # runs in the worker thread, with the context (hence the profilers) of the request
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profilers = _profilers.get()
+        if profilers is None:
+            return endpoint(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+    return wrapper
+
+
+def _skipped(response: Response, reason: str) -> Response:
+    response.headers["X-Profile-Skipped"] = reason
+    return response
+
+
+class ProfilingRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs):
+        self.profiled = PROFILING_ENABLED and not iscoroutinefunction(endpoint)
+        super().__init__(path, _profiled(endpoint) if self.profiled and _PER_THREAD else endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        route_handler = super().get_route_handler()
+        if not self.profiled:
+            return route_handler
+
+        async def profiling_route_handler(request: Request) -> Response:
+            token = request.headers.get(PROFILING_HEADER)
+            if not _has_valid_token(token) and random() >= PROFILING_SAMPLE_RATE:
+                return await route_handler(request)
+
+            profiler = cProfile.Profile()
+            if not _profiling_lock.acquire(blocking=False):
+                return _skipped(await route_handler(request), "another request is being profiled")
+            try:
+                profiler.enable()
+            except ValueError:
+                # as of Python 3.12, another profiling tool may be active
+                _profiling_lock.release()
+                return _skipped(await route_handler(request), "another profiler is active")
+
+            profilers = [profiler]
+            reset_token = _profilers.set(profilers)
+            start = perf_counter()
+            try:
+                response = await route_handler(request)
+            finally:
+                # errors (e.g., 404) are profiled too, though they get no X-Profile-Id header
+                profiler.disable()
+                _profiling_lock.release()
+                _profilers.reset(reset_token)
+                duration_ms = (perf_counter() - start) * 1000
+                profile_id = profile_store.add(request.method, request.url.path, self.path, duration_ms, profilers)
+            if profile_id is not None:
+                response.headers["X-Profile-Id"] = str(profile_id)
+            return response
+
+        return profiling_route_handler
+
+
+#
+# Admin routes (only included in the API when PROFILING_ENABLED is true)
+#
+
+
+def verify_profiling_token(token: Annotated[str | None, Header(alias=PROFILING_HEADER)] = None):
+    if not _has_valid_token(token):
+        raise HTTPException(401, "Invalid profiling token")
+
+
+SortQuery = Annotated[str, Query(description="pstats sort key (e.g., cumulative, tottime, ncalls)")]
+LimitQuery = Annotated[int, Query(description="Number of functions to print")]
+
+
+def _print_stats(stats: pstats.Stats, sort: str, limit: int) -> str:
+    stream = io.StringIO()
+    stats.stream = stream  # type: ignore[attr-defined]
+    try:
+        stats.sort_stats(sort).print_stats(limit)
+    except KeyError:
+        raise HTTPException(422, f"Invalid sort key '{sort}'")
+    return stream.getvalue()
+
+
+profiling_router = APIRouter(prefix="/profiles", tags=["profiles"], dependencies=[Depends(verify_profiling_token)])
+
+
+@profiling_router.get("", status_code=200)
+def get_profiles():
+    return {
+        "routes": profile_store.routes(),
+        "recent": [
+            {"id": p.id, "method": p.method, "path": p.path, "route": p.route, "duration_ms": p.duration_ms}
+            for p in profile_store.recent()
+        ],
+    }
+
+
+@profiling_router.get("/routes", status_code=200, response_class=PlainTextResponse)
+def get_route_profile(
+    route: Annotated[str, Query(description="Route template (e.g., /users/{username})")],
+    sort: SortQuery = "cumulative",
+    limit: LimitQuery = 30,
+):
+    stats = profile_store.route_stats(route)
+    if stats is None:
+        raise HTTPException(404, "Given route has not been profiled")
+    return _print_stats(stats, sort, limit)
+
+
+@profiling_router.get("/requests/{profile_id}", status_code=200, response_class=PlainTextResponse)
+def get_request_profile(profile_id: int, sort: SortQuery = "cumulative", limit: LimitQuery = 30):
+    stats = profile_store.request_stats(profile_id)
+    if stats is None:
+        raise HTTPException(404, "Given profile does not exist (anymore)")
+    return _print_stats(stats, sort, limit)
+
+
+@profiling_router.delete("", status_code=204)
+def delete_profiles():
+    profile_store.clear()
@@ -0,0 +1,83 @@
+from contextlib import closing
+
+from pyfreeradius.repositories import BaseRepository
+
+#
+# Prefix search (e.g., "alice@" or "cust-1234-") of usernames, groupnames and nasnames.
+#
+# The search is a "name LIKE 'prefix%'" (with the "%" and "_" wildcards of the
+# prefix escaped) which the database may resolve with a range scan of the name
+# index. Unlike a computed range "name >= prefix AND name < upper_bound", it
+# follows the collation of the column (e.g., MySQL's utf8mb4_0900_ai_ci does not
+# compare by code point). The condition is pushed into each branch of the UNION
+# so that every table uses its own index.
+#
+# "!" is the escape character since "\" is itself one in MySQL string literals
+# but not in standard SQL (PostgreSQL, SQLite).
+#
+# Just like the collection routes, results are paginated by keyset ("name_gt").
+#
+
+
+def like_pattern(prefix: str) -> str:
+    escaped = prefix.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+    return f"{escaped}%"
+
+
+class SearchRepository(BaseRepository):
+    def _find_names(self, key: str, tables: list[str], prefix: str, limit: int | None, name_gt: str | None):
+        where_clauses = [f"{key} LIKE {self.ph} ESCAPE '!'"]
+        branch_params: list[str] = [like_pattern(prefix)]
+
+        if name_gt:
+            # used for keyset pagination
+            where_clauses.append(f"{key} > {self.ph}")
+            branch_params.append(name_gt)
+
+        where_clauses_as_text = " AND ".join(where_clauses)
+        branches = [f"SELECT DISTINCT {key} FROM {table} WHERE {where_clauses_as_text}" for table in tables]
+        params: list[str | int] = [*branch_params * len(tables)]
+
+        limit_clause = ""
+        if limit:
+            limit_clause = f"LIMIT {self.ph}"
+            params.append(limit)
+
+        sql = f"SELECT {key} FROM ({' UNION '.join(branches)}) n ORDER BY {key} {limit_clause}"
+
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(sql, tuple(params))
+            return [name for (name,) in db_cursor.fetchall()]
+
+    def _count_names(self, key: str, tables: list[str], prefix: str) -> int:
+        # unlike the total counts, these are not cached (there are too many prefixes)
+        # DISTINCT as a single branch (e.g., nasnames) has no UNION to drop duplicates
+        branches = [f"SELECT DISTINCT {key} FROM {table} WHERE {key} LIKE {self.ph} ESCAPE '!'" for table in tables]
+        sql = f"SELECT COUNT(*) FROM ({' UNION '.join(branches)}) n"
+
+        with closing(self.db_session.cursor()) as db_cursor:
+            db_cursor.execute(sql, (like_pattern(prefix),) * len(tables))
+            (count,) = db_cursor.fetchone()
+            return count
+
+    def find_usernames(self, prefix: str, limit: int | None = 100, username_gt: str | None = None) -> list[str]:
+        tables = [self.rad_tables.radcheck, self.rad_tables.radreply, self.rad_tables.radusergroup]
+        return self._find_names("username", tables, prefix, limit, username_gt)
+
+    def find_groupnames(self, prefix: str, limit: int | None = 100, groupname_gt: str | None = None) -> list[str]:
+        tables = [self.rad_tables.radgroupcheck, self.rad_tables.radgroupreply, self.rad_tables.radusergroup]
+        return self._find_names("groupname", tables, prefix, limit, groupname_gt)
+
+    def find_nasnames(self, prefix: str, limit: int | None = 100, nasname_gt: str | None = None) -> list[str]:
+        return self._find_names("nasname", [self.rad_tables.nas], prefix, limit, nasname_gt)
+
+    def count_usernames(self, prefix: str) -> int:
+        tables = [self.rad_tables.radcheck, self.rad_tables.radreply, self.rad_tables.radusergroup]
+        return self._count_names("username", tables, prefix)
+
+    def count_groupnames(self, prefix: str) -> int:
+        tables = [self.rad_tables.radgroupcheck, self.rad_tables.radgroupreply, self.rad_tables.radusergroup]
+        return self._count_names("groupname", tables, prefix)
+
+    def count_nasnames(self, prefix: str) -> int:
+        return self._count_names("nasname", [self.rad_tables.nas], prefix)
@@ -30,3 +30,39 @@ RAD_TABLES = RadTables(
 # after a resource has been created (POST) as per RFC 7231
 # and the "Link" header field (pagination) as per RFC 8288
 API_URL = "http://localhost:8000"
+
+# Exact counts (X-Total-Count header and "/stats") are cached this many seconds
+# and adjusted by the API write routes in between
+COUNT_CACHE_TTL_SECONDS = 30
+
+# The in-memory NAS index (used by "/nas:lookup") is updated on NAS writes
+# and fully reloaded from the database after this many seconds
+NAS_INDEX_REFRESH_SECONDS = 300
+
+# Responses are compressed (gzip, plus br and zstd if the "brotli" and "zstandard"
+# packages are installed) when the client accepts it and the body is large enough
+# (an encoding missing from COMPRESSION_LEVELS is compressed at its default level)
+COMPRESSION_MINIMUM_SIZE = 500
+COMPRESSION_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+
+# Opt-in profiling of the API routes (see "/profiles" admin routes): a fraction of
+# the requests is sampled and any request carrying the PROFILING_HEADER set to the
+# PROFILING_TOKEN is profiled (the token is also required by the admin routes)
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_HEADER = "X-Profiling-Token"
+PROFILING_TOKEN: str | None = None
+PROFILING_MAX_RECENT = 50
+
+# Output directory of the "users" and "clients.conf" files export (see "export.py")
+# and number of files each of them is split into (only changed files are rewritten)
+EXPORT_DIR = "export"
+EXPORT_SHARDS = 16
+EXPORT_FILE_MODE = 0o640  # of newly created files (existing files keep their mode)
+
+# Coherence of the in-process state (NAS index, cached counts) across API workers:
+# writes bump a generation number in GENERATION_TABLE (see "2-schema.sql") which
+# workers check every COHERENCE_CHECK_SECONDS at most, dropping the stale state
+COHERENCE_ENABLED = False
+COHERENCE_CHECK_SECONDS = 1
+GENERATION_TABLE = "radapi_generation"
@@ -1,6 +1,19 @@
-from fastapi.testclient import TestClient
+from contextlib import closing
+from threading import Event, Thread
+from time import monotonic
 
-from api import app
+from fastapi.testclient import TestClient
+from pyfreeradius.models import Nas
+from pyfreeradius.repositories import NasRepository
+
+import counts
+from api import app, next_page_link
+from coherence import GenerationRepository, coherence
+from counts import CountCache, count_cache, group_users_key
+from database import db_connect
+from nas_index import NasIndex, nas_index
+from search import like_pattern
+from settings import API_URL, RAD_TABLES
 
 client = TestClient(app)
 
@@ -69,6 +82,10 @@ post_nas = {"nasname": "5.5.5.5", "secret": "my-secret", "shortname": "my-nas"}
 
 patch_nas = {"secret": "new-secret", "shortname": "new-nas"}
 
+post_nas_prefix = {"nasname": "10.20.0.0/16", "secret": "prefix-secret", "shortname": "prefix-nas"}
+
+post_nas_host = {"nasname": "10.20.30.40", "secret": "host-secret", "shortname": "host-nas"}
+
 # Expected results
 
 get_group = {
@@ -181,6 +198,264 @@ def test_nas():
     assert response.status_code == 404  # NAS now not found
 
 
+def test_nas_lookup():
+    response = client.get("/nas:lookup", params={"ip": "not-an-ip"})
+    assert response.status_code == 422
+
+    response = client.get("/nas:lookup", params={"ip": "10.20.30.40"})
+    assert response.status_code == 404  # no NAS covers this IP yet
+
+    response = client.post("/nas", json=post_nas_prefix)
+    assert response.status_code == 201
+    response = client.post("/nas", json=post_nas_host)
+    assert response.status_code == 201
+
+    response = client.get("/nas:lookup", params={"ip": "10.20.30.40"})
+    assert response.status_code == 200
+    assert response.json() == post_nas_host  # longest prefix wins
+
+    response = client.get("/nas:lookup", params={"ip": "10.20.99.1"})
+    assert response.status_code == 200
+    assert response.json() == post_nas_prefix
+
+    response = client.get("/nas:lookup", params={"ip": "::ffff:10.20.99.1"})
+    assert response.status_code == 200
+    assert response.json() == post_nas_prefix  # IPv4-mapped IPv6 address
+
+    response = client.patch("/nas/10.20.30.40", json=patch_nas)
+    assert response.status_code == 200
+    response = client.get("/nas:lookup", params={"ip": "10.20.30.40"})
+    assert response.json() == post_nas_host | patch_nas  # index updated on patch
+
+    response = client.delete("/nas/10.20.30.40")
+    assert response.status_code == 204
+    response = client.get("/nas:lookup", params={"ip": "10.20.30.40"})
+    assert response.status_code == 200
+    assert response.json() == post_nas_prefix  # index updated on delete
+
+    # a CIDR nasname cannot be part of a URL path, so we clean it up directly
+    with closing(db_connect()) as db_session:
+        NasRepository(db_session, RAD_TABLES).remove("10.20.0.0/16")
+        db_session.commit()
+    nas_index.reload()
+
+    response = client.get("/nas:lookup", params={"ip": "10.20.30.40"})
+    assert response.status_code == 404
+
+
+def test_nas_index_reload(monkeypatch):
+    index = NasIndex()
+    nas = Nas(**post_nas_host)
+
+    def find_nases():
+        # the NAS is added (and committed) while the reload query is running
+        index.add(nas)
+        return []
+
+    monkeypatch.setattr(index, "_find_nases", find_nases)
+    index.reload()
+    assert index.lookup("10.20.30.40") == nas  # the update has not been lost
+
+    # an invalidation during the reload leaves the index stale
+    monkeypatch.setattr(index, "_find_nases", lambda: index.invalidate() or [])
+    index.reload()
+    assert index.is_stale()
+
+
+def test_nas_index_concurrent_reload(monkeypatch):
+    index = NasIndex()
+    nas = Nas(**post_nas_host)
+    index.load([nas])
+    index.invalidate()
+
+    started, release = Event(), Event()
+
+    def find_nases():
+        started.set()
+        release.wait(5)
+        return []
+
+    monkeypatch.setattr(index, "_find_nases", find_nases)
+    reloader = Thread(target=index.lookup, args=("1.2.3.4",))
+    reloader.start()
+    assert started.wait(5)
+
+    # while the index is being reloaded, lookups are answered from the current trees
+    start = monotonic()
+    assert index.lookup("10.20.30.40") == nas
+    assert monotonic() - start < 1
+
+    release.set()
+    reloader.join(5)
+    assert index.lookup("10.20.30.40") is None  # reloaded
+
+
+def test_stats():
+    response = client.get("/stats")
+    assert response.status_code == 200
+    stats = response.json()
+
+    response = client.get("/stats", params={"approximate": True})
+    assert response.status_code == 200
+    assert response.json().keys() == stats.keys()
+
+    response = client.get("/stats/groups/g")
+    assert response.status_code == 404  # group not found yet
+    assert group_users_key("g") not in count_cache._counts  # nothing cached for a nonexistent group
+
+    response = client.post("/nas", json=post_nas)
+    assert response.status_code == 201
+    response = client.post("/users", json=post_user)
+    assert response.status_code == 201
+    response = client.post("/groups", json=post_group_only_user)
+    assert response.status_code == 201
+
+    response = client.get("/stats")
+    assert response.json() == {"users": stats["users"] + 1, "groups": stats["groups"] + 1, "nas": stats["nas"] + 1}
+
+    response = client.get("/stats/groups/g")
+    assert response.status_code == 200
+    assert response.json() == {"groupname": "g", "users": 1}
+
+    response = client.get("/nas")
+    assert "X-Total-Count" not in response.headers  # opt-in only
+
+    response = client.get("/nas", params={"with_total": True})
+    assert response.headers["X-Total-Count"] == str(stats["nas"] + 1)
+    response = client.get("/users", params={"with_total": True})
+    assert response.headers["X-Total-Count"] == str(stats["users"] + 1)
+    response = client.get("/groups", params={"with_total": True})
+    assert response.headers["X-Total-Count"] == str(stats["groups"] + 1)
+
+    response = client.patch("/groups/g", json={"users": [], "replies": post_group["replies"]})
+    assert response.status_code == 200
+    response = client.get("/stats/groups/g")
+    assert response.json() == {"groupname": "g", "users": 0}
+
+    response = client.delete("/nas/5.5.5.5")
+    assert response.status_code == 204
+    response = client.delete("/users/u")
+    assert response.status_code == 204
+    response = client.delete("/groups/g")
+    assert response.status_code == 204
+
+    response = client.get("/stats")
+    assert response.json() == stats
+
+
+def test_count_cache(monkeypatch):
+    cache = CountCache(ttl_seconds=30)
+    now = monotonic()
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    monkeypatch.setattr(counts, "monotonic", lambda: now + 60)
+    cache.set("c", 3)
+    assert cache._counts.keys() == {"c"}  # expired counts have been purged
+
+
+def test_like_pattern():
+    assert like_pattern("alice@") == "alice@%"
+    assert like_pattern("50%_off!") == "50!%!_off!!%"
+
+
+def test_next_page_link():
+    assert next_page_link("users", "username_gt", "a+b@c/d", prefix="a+b", keys_only=True) == (
+        f'<{API_URL}/users?username_gt=a%2Bb%40c%2Fd&prefix=a%2Bb&keys_only=true>; rel="next"'
+    )
+
+
+def test_search():
+    for username in ["cust-1234-a", "cust-1234-b", "cust-1235-a"]:
+        response = client.post("/users", json=post_user | {"username": username})
+        assert response.status_code == 201
+    for nasname in ["6.6.6.1", "6.6.6.2", "6.6.7.1"]:
+        response = client.post("/nas", json=post_nas | {"nasname": nasname})
+        assert response.status_code == 201
+    response = client.post("/groups", json=post_group | {"groupname": "cust-1234-g"})
+    assert response.status_code == 201
+
+    response = client.get("/users", params={"prefix": "cust-1234-", "keys_only": True})
+    assert response.status_code == 200
+    assert response.json() == ["cust-1234-a", "cust-1234-b"]
+    assert response.headers["Link"] == (
+        f'<{API_URL}/users?username_gt=cust-1234-b&prefix=cust-1234-&keys_only=true>; rel="next"'
+    )
+
+    response = client.get("/users", params={"prefix": "cust-1234-", "username_gt": "cust-1234-a"})
+    assert response.status_code == 200
+    assert response.json() == [post_user | {"username": "cust-1234-b", "groups": []}]
+
+    response = client.get("/users", params={"prefix": "cust-1234", "keys_only": True, "with_total": True})
+    assert response.json() == ["cust-1234-a", "cust-1234-b"]  # prefix ending in a digit
+    assert response.headers["X-Total-Count"] == "2"  # number of items matching the prefix
+
+    response = client.get("/users", params={"prefix": "cust-1234-b", "keys_only": True})
+    assert response.json() == ["cust-1234-b"]
+
+    response = client.get("/users", params={"prefix": "cust_", "keys_only": True})
+    assert response.json() == []  # "_" is not a wildcard
+
+    response = client.get("/users", params={"prefix": "cust-9"})
+    assert response.json() == []
+    assert "Link" not in response.headers  # no more results
+
+    response = client.get("/groups", params={"prefix": "cust-", "keys_only": True})
+    assert response.json() == ["cust-1234-g"]
+
+    response = client.get("/nas", params={"prefix": "6.6.6."})
+    assert [nas["nasname"] for nas in response.json()] == ["6.6.6.1", "6.6.6.2"]
+
+    # the schema does not prevent duplicate nasnames: they are counted once, as in the total counts
+    with closing(db_connect()) as db_session:
+        NasRepository(db_session, RAD_TABLES).add(Nas(**post_nas | {"nasname": "6.6.6.1"}))
+        db_session.commit()
+    response = client.get("/nas", params={"prefix": "6.6.6.", "keys_only": True, "with_total": True})
+    assert response.json() == ["6.6.6.1", "6.6.6.2"]
+    assert response.headers["X-Total-Count"] == "2"
+
+    for username in ["cust-1234-a", "cust-1234-b", "cust-1235-a"]:
+        assert client.delete(f"/users/{username}").status_code == 204
+    for nasname in ["6.6.6.1", "6.6.6.2", "6.6.7.1"]:
+        assert client.delete(f"/nas/{nasname}").status_code == 204
+    assert client.delete("/groups/cust-1234-g").status_code == 204
+
+
+def test_coherence(monkeypatch):
+    monkeypatch.setattr(coherence, "enabled", True)
+    monkeypatch.setattr(coherence, "check_seconds", 0)
+    other_nas = post_nas | {"nasname": "7.7.7.7"}
+
+    response = client.get("/stats")
+    assert response.status_code == 200
+    stats = response.json()  # the NAS count is now cached
+
+    response = client.post("/nas", json=post_nas)
+    assert response.status_code == 201  # own write: the cached count is adjusted, not dropped
+    response = client.get("/stats")
+    assert response.json()["nas"] == stats["nas"] + 1
+
+    # own write rolled back: its generation must not be taken as seen (post-commit hooks are not run)
+    with closing(db_connect()) as db_session:
+        coherence.bump(db_session, "nas", [])
+        db_session.rollback()
+
+    # another worker adds a NAS and bumps the generation in the same transaction
+    with closing(db_connect()) as db_session:
+        NasRepository(db_session, RAD_TABLES).add(Nas(**other_nas))
+        GenerationRepository(db_session).bump("nas")
+        db_session.commit()
+
+    response = client.get("/stats")
+    assert response.json()["nas"] == stats["nas"] + 2  # the cached count has been dropped
+    response = client.get("/nas:lookup", params={"ip": "7.7.7.7"})
+    assert response.status_code == 200  # the NAS index has been reloaded
+    assert response.json() == other_nas
+
+    assert client.delete("/nas/5.5.5.5").status_code == 204
+    assert client.delete("/nas/7.7.7.7").status_code == 204
+
+
 def test_group():
     response = client.get("/groups/g")
     assert response.status_code == 404  # group not found yet
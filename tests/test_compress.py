@@ -0,0 +1,72 @@
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from compress import ENCODERS, CompressionMiddleware, negotiate_encoding
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size=100, levels={"gzip": 6, "br": 4, "zstd": 3})
+
+chunk = '{"attribute": "Framed-Route", "op": "+=", "value": "192.168.1.0/24"}' * 10
+
+
+@app.get("/small")
+def get_small():
+    return PlainTextResponse("tiny")
+
+
+@app.get("/large")
+def get_large():
+    return PlainTextResponse(chunk)
+
+
+@app.get("/stream")
+def get_stream():
+    return StreamingResponse(iter([chunk] * 5 + [""]), media_type="text/plain")
+
+
+client = TestClient(app)
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") is not None
+    assert negotiate_encoding("*, gzip;q=0") != "gzip"
+
+
+def test_compression():
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers  # below minimum size
+    assert response.text == "tiny"
+
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers  # not accepted by the client
+    assert response.text == chunk
+
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(chunk)
+    assert response.text == chunk
+
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers  # still streamed
+    assert response.text == chunk * 5
+
+
+def test_compression_default_levels():
+    # encodings offered (e.g., zstd once "zstandard" is installed) without a configured level
+    default_levels_app = FastAPI()
+    default_levels_app.add_middleware(CompressionMiddleware, minimum_size=100, levels={})
+    default_levels_app.get("/large")(get_large)
+    default_levels_client = TestClient(default_levels_app)
+
+    for encoding in ENCODERS:
+        response = default_levels_client.get("/large", headers={"Accept-Encoding": encoding})
+        assert response.headers["content-encoding"] == encoding
+        assert int(response.headers["content-length"]) < len(chunk)
@@ -0,0 +1,133 @@
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from pyfreeradius.models import AttributeOpValue, Nas
+
+import api
+from export import format_client, format_user
+
+client = TestClient(api.app)
+
+
+def test_format_user():
+    checks = [AttributeOpValue(attribute="Cleartext-Password", op=":=", value="it's \\ %{secret}")]
+    replies = [
+        AttributeOpValue(attribute="Framed-IP-Address", op=":=", value="10.0.0.1"),
+        AttributeOpValue(attribute="Filter-Id", op=":=", value="10m"),
+    ]
+    assert format_user("u@realm", checks, replies) == (
+        "u@realm\tCleartext-Password := 'it\\'s \\\\ %{secret}'\n"
+        "\tFramed-IP-Address := '10.0.0.1',\n\tFilter-Id := '10m'\n\n"
+    )
+    assert format_user("john doe", [], replies[:1]) == "'john doe'\n\tFramed-IP-Address := '10.0.0.1'\n\n"
+    assert format_user("u", checks[:0], []) == "u\n\n"
+
+
+def test_format_user_groups():
+    group_checks = [AttributeOpValue(attribute="NAS-IP-Address", op="==", value="10.0.0.1")]
+    group_replies = [AttributeOpValue(attribute="Filter-Id", op=":=", value="10m")]
+    replies = [AttributeOpValue(attribute="Framed-IP-Address", op=":=", value="10.0.0.1")]
+    fall_through = [AttributeOpValue(attribute="Fall-Through", op="=", value="Yes")]
+
+    # a group check item only conditions the group reply items
+    assert format_user("u", [], replies, [(group_checks, group_replies)]) == (
+        "u\n\tFramed-IP-Address := '10.0.0.1',\n\tFall-Through = Yes\n\n"
+        "u\tNAS-IP-Address == '10.0.0.1'\n\tFilter-Id := '10m'\n\n"
+    )
+    # the next group is only processed if the previous one (if matching) falls through
+    assert format_user("u", [], [], [([], group_replies), ([], []), ([], group_replies + fall_through)]) == (
+        "u\n\tFilter-Id := '10m'\n\nu\n\nu\n\tFilter-Id := '10m',\n\tFall-Through = 'Yes'\n\n"
+    )
+    assert format_user("u", [], [], [(group_checks, group_replies)]) == (
+        "u\tNAS-IP-Address == '10.0.0.1'\n\tFilter-Id := '10m'\n\n"
+    )
+
+
+def test_format_user_invalid():
+    reply = AttributeOpValue(attribute="Filter-Id", op=":=", value="10m")
+    with pytest.raises(ValueError, match="control character"):
+        format_user("u", [], [reply.model_copy(update={"value": "10m'\nDEFAULT\tAuth-Type := Accept"})])
+    with pytest.raises(ValueError, match="control character"):
+        format_user("u\n", [], [reply])
+    with pytest.raises(ValueError, match="invalid attribute"):
+        format_user("u", [], [reply.model_copy(update={"attribute": "Filter-Id := 'x', Auth-Type"})])
+    with pytest.raises(ValueError, match="invalid operator"):
+        format_user("u", [], [reply.model_copy(update={"op": "= 'x', Auth-Type :="})])
+    with pytest.raises(ValueError, match="DEFAULT"):
+        format_user("DEFAULT", [], [reply])
+
+
+def test_format_client():
+    nas = Nas(nasname="10.0.0.0/8", shortname="my-nas", secret="my-secret")
+    assert format_client(nas) == (
+        "client 10.0.0.0/8 {\n\tipaddr = '10.0.0.0/8'\n\tsecret = 'my-secret'\n\tshortname = 'my-nas'\n}\n\n"
+    )
+    with pytest.raises(ValueError, match="invalid nasname"):
+        format_client(nas.model_copy(update={"nasname": "10.0.0.1 { secret = x }"}))
+    with pytest.raises(ValueError, match="control character"):
+        format_client(nas.model_copy(update={"secret": "my-secret\n}"}))
+
+
+def read_all(output_dir: Path, stem: str) -> str:
+    return "".join(path.read_text() for path in sorted((output_dir / f"{stem}.d").iterdir()))
+
+
+def test_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "EXPORT_DIR", str(tmp_path))
+
+    group = {"groupname": "g", "checks": [{"attribute": "Auth-Type", "op": ":=", "value": "Accept"}]}
+    group |= {"replies": [{"attribute": "Filter-Id", "op": ":=", "value": "10m"}]}
+    user = {"username": "u", "replies": [{"attribute": "Framed-IP-Address", "op": ":=", "value": "10.0.0.1"}]}
+    user |= {"groups": [{"groupname": "g", "priority": 1}, {"groupname": "g2", "priority": 2}]}
+    group2 = {"groupname": "g2", "replies": [{"attribute": "Filter-Id", "op": ":=", "value": "20m"}]}
+    nas = {"nasname": "5.5.5.5", "secret": "my-secret", "shortname": "my-nas"}
+    assert client.post("/groups", json=group).status_code == 201
+    assert client.post("/groups", json=group2).status_code == 201
+    assert client.post("/users", json=user).status_code == 201
+    assert client.post("/nas", json=nas).status_code == 201
+
+    response = client.post("/export")
+    assert response.status_code == 200
+    assert response.json()["users"] >= 1
+    assert response.json()["nas"] >= 1
+    assert (tmp_path / "users").read_text().count("$INCLUDE users.d/users-") == 16
+    assert (tmp_path / "clients.conf").read_text().count("$INCLUDE clients.d/clients-") == 16
+    # g2 is only processed if g does not match (g does not fall through)
+    assert (
+        "u\n\tFramed-IP-Address := '10.0.0.1',\n\tFall-Through = Yes\n\n"
+        "u\tAuth-Type := 'Accept'\n\tFilter-Id := '10m'\n\n"
+        "u\n\tFilter-Id := '20m'\n\n" in read_all(tmp_path, "users")
+    )
+    assert "client 5.5.5.5 {\n\tipaddr = '5.5.5.5'\n\tsecret = 'my-secret'" in read_all(tmp_path, "clients")
+    assert (tmp_path / "users").stat().st_mode & 0o777 == 0o640
+
+    response = client.post("/export")
+    assert response.json()["written"] == []  # nothing changed
+
+    for path in (tmp_path / "clients.d").iterdir():
+        path.chmod(0o644)
+    assert client.patch("/nas/5.5.5.5", json={"secret": "new-secret"}).status_code == 200
+    response = client.post("/export")
+    assert len(response.json()["written"]) == 1  # only the shard of the NAS
+    assert "secret = 'new-secret'" in Path(response.json()["written"][0]).read_text()
+    assert Path(response.json()["written"][0]).stat().st_mode & 0o777 == 0o644  # mode kept
+
+    # users which cannot be safely exported are skipped and reported
+    default = {"username": "DEFAULT", "replies": [{"attribute": "Auth-Type", "op": ":=", "value": "Accept"}]}
+    newline = {"username": "v", "replies": [{"attribute": "Filter-Id", "op": ":=", "value": "10m'\nDEFAULT"}]}
+    assert client.post("/users", json=default).status_code == 201
+    assert client.post("/users", json=newline).status_code == 201
+    response = client.post("/export")
+    assert response.json()["skipped"] == [
+        "user 'DEFAULT': username DEFAULT would match any user",
+        "user 'v': control character in \"10m'\\nDEFAULT\"",
+    ]
+    assert "DEFAULT" not in read_all(tmp_path, "users")
+
+    assert client.delete("/users/DEFAULT").status_code == 204
+    assert client.delete("/users/v").status_code == 204
+    assert client.delete("/nas/5.5.5.5").status_code == 204
+    assert client.delete("/users/u").status_code == 204
+    assert client.delete("/groups/g").status_code == 204
+    assert client.delete("/groups/g2").status_code == 204
@@ -0,0 +1,107 @@
+from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import profiling
+from profiling import ProfilingRoute, profile_store, profiling_router
+
+
+def make_client(monkeypatch, sample_rate: float = 0.0) -> TestClient:
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", sample_rate)
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "my-token")
+
+    router = APIRouter(route_class=ProfilingRoute)
+
+    @router.get("/items/{name}")
+    def get_item(name: str):
+        if name == "missing":
+            raise HTTPException(404, "Item not found")
+        return {"name": name, "total": sum(range(1000))}
+
+    app = FastAPI()
+    app.include_router(router)
+    app.include_router(profiling_router)
+    profile_store.clear()
+    return TestClient(app)
+
+
+def test_profiling_disabled():
+    router = APIRouter(route_class=ProfilingRoute)
+
+    @router.get("/")
+    def read_root():
+        return {}
+
+    assert not router.routes[0].profiled  # type: ignore[attr-defined]
+
+
+def test_profiling_header(monkeypatch):
+    client = make_client(monkeypatch)
+    token = {"X-Profiling-Token": "my-token"}
+
+    response = client.get("/items/a")
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers  # not sampled and no token
+
+    response = client.get("/items/a", headers={"X-Profiling-Token": "bad-token"})
+    assert "X-Profile-Id" not in response.headers
+
+    response = client.get("/profiles")
+    assert response.status_code == 401  # admin routes require the token
+
+    response = client.get("/items/a", headers=token)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    response = client.get("/items/missing", headers=token)
+    assert response.status_code == 404  # errors are profiled too
+
+    response = client.get("/profiles", headers=token)
+    assert response.status_code == 200
+    assert response.json()["routes"] == {"/items/{name}": 2}
+    assert [p["path"] for p in response.json()["recent"]] == ["/items/a", "/items/missing"]
+
+    response = client.get(f"/profiles/requests/{profile_id}", params={"limit": 1000}, headers=token)
+    assert response.status_code == 200
+    assert "get_item" in response.text
+
+    response = client.get("/profiles/routes", params={"route": "/items/{name}", "limit": 1000}, headers=token)
+    assert response.status_code == 200
+    assert "get_item" in response.text
+
+    # admin routes print copies, which requests being profiled meanwhile cannot alter
+    assert profile_store.route_stats("/items/{name}") is not profile_store.route_stats("/items/{name}")
+    assert profile_store.request_stats(int(profile_id)) is not profile_store.request_stats(int(profile_id))
+
+    response = client.get("/profiles/routes", params={"route": "/items/{name}", "sort": "bad"}, headers=token)
+    assert response.status_code == 422
+
+    response = client.get("/profiles/routes", params={"route": "/unknown"}, headers=token)
+    assert response.status_code == 404
+
+    response = client.delete("/profiles", headers=token)
+    assert response.status_code == 204
+    response = client.get(f"/profiles/requests/{profile_id}", headers=token)
+    assert response.status_code == 404
+
+
+def test_profiling_sampling(monkeypatch):
+    client = make_client(monkeypatch, sample_rate=1.0)
+
+    response = client.get("/items/a")
+    assert response.status_code == 200
+    assert "X-Profile-Id" in response.headers
+
+
+def test_profiling_one_at_a_time(monkeypatch):
+    client = make_client(monkeypatch)
+    token = {"X-Profiling-Token": "my-token"}
+
+    with profiling._profiling_lock:  # as if another request was being profiled
+        response = client.get("/items/a", headers=token)
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert response.headers["X-Profile-Skipped"] == "another request is being profiled"
+
+    response = client.get("/items/a", headers=token)
+    assert "X-Profile-Id" in response.headers